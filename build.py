@@ -1,12 +1,21 @@
 import logging
+import multiprocessing
+import os
+import tempfile
 import time
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
-import pandas as pd
-from shapely.geometry import Point
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+import rapidgzip
+from astropy import units as u
+from astropy_healpix import HEALPix
 
-from starplot import Star
-from starplot.data import Catalog, utils
+from starplot.data import utils
 
 
 __version__ = "0.1.3"
@@ -18,146 +27,293 @@ BUILD_PATH = HERE / "build"
 BIG_SKY_VERSION = "0.4.1"
 BIG_SKY_FILENAME = f"bigsky.{BIG_SKY_VERSION}.stars.csv.gz"
 BIG_SKY_PQ_FILENAME = f"bigsky.{BIG_SKY_VERSION}.stars.parquet"
+BIG_SKY_INDEX_FILENAME = f"{BIG_SKY_FILENAME}.gzindex"
+
+BIG_SKY_COLUMN_TYPES = {
+    "tyc_id": pa.string(),
+    "hip_id": pa.int32(),
+    "ccdm": pa.string(),
+    "magnitude": pa.float32(),
+    "bv": pa.float32(),
+    "ra_degrees_j2000": pa.float64(),
+    "dec_degrees_j2000": pa.float64(),
+    "ra_mas_per_year": pa.float32(),
+    "dec_mas_per_year": pa.float32(),
+    "parallax_mas": pa.float32(),
+    "constellation": pa.string(),
+}
+
+HEALPIX_NSIDE = 4
+ROW_GROUP_BYTES = 8 << 20
+SORTING_COLUMNS = ["healpix_index", "magnitude"]
+
+# little-endian 2D WKB Point: byte order, geometry type, x, y
+WKB_POINT = np.dtype(
+    [("byte_order", "u1"), ("type", "<u4"), ("x", "<f8"), ("y", "<f8")]
+)
 
 BIG_SKY_DOWNLOAD_URL = f"https://github.com/steveberardi/bigsky/releases/download/v{BIG_SKY_VERSION}/{BIG_SKY_FILENAME}"
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
-console_handler = logging.StreamHandler()
-file_handler = logging.FileHandler("build.log", mode="a")
-logger.addHandler(console_handler)
-logger.addHandler(file_handler)
+
 formatter = logging.Formatter(
     "{asctime} - {levelname} - {message}",
     style="{",
     datefmt="%Y-%m-%d %H:%M:%S",
 )
-console_handler.setFormatter(formatter)
-file_handler.setFormatter(formatter)
 
 
-def build_magnitude(limiting_magnitude: float, expected_count: int):
+def _init_logging():
+    if logger.handlers:
+        return
+
+    console_handler = logging.StreamHandler()
+    file_handler = logging.FileHandler("build.log", mode="a")
+    console_handler.setFormatter(formatter)
+    file_handler.setFormatter(formatter)
+    logger.addHandler(console_handler)
+    logger.addHandler(file_handler)
+
+
+def open_gzip(path: Path, index_path: Path) -> rapidgzip.RapidgzipFile:
+    f = rapidgzip.RapidgzipFile(str(path), parallelization=os.cpu_count())
+
+    if index_path.is_file():
+        try:
+            f.import_index(str(index_path))
+        except (ValueError, RuntimeError) as e:
+            logger.warning(f"Ignoring unreadable gzip index {index_path.name}: {e}")
+            f.close()
+            index_path.unlink()
+            f = rapidgzip.RapidgzipFile(str(path), parallelization=os.cpu_count())
+
+    return f
+
+
+def read_bigsky_csv(bigsky_path: Path) -> pa.Table:
+    bigsky_index_path = DATA_PATH / BIG_SKY_INDEX_FILENAME
+
+    with open_gzip(bigsky_path, bigsky_index_path) as f:
+        table = pacsv.read_csv(
+            f,
+            convert_options=pacsv.ConvertOptions(
+                include_columns=list(BIG_SKY_COLUMN_TYPES),
+                column_types=BIG_SKY_COLUMN_TYPES,
+                strings_can_be_null=True,
+            ),
+        )
+
+        if not bigsky_index_path.is_file():
+            tmp_path = bigsky_index_path.with_name(f"{bigsky_index_path.name}.tmp")
+            f.export_index(str(tmp_path))
+            tmp_path.replace(bigsky_index_path)
+
+    return table
+
+
+def load_bigsky() -> pa.Table:
     bigsky_path = DATA_PATH / BIG_SKY_FILENAME
+    bigsky_pq_path = DATA_PATH / BIG_SKY_PQ_FILENAME
+
+    # the cache only holds the raw CSV columns, so it's rebuilt whenever the types change
+    if bigsky_pq_path.is_file() and pq.read_schema(bigsky_pq_path).equals(
+        pa.schema(BIG_SKY_COLUMN_TYPES.items())
+    ):
+        table = pq.read_table(bigsky_pq_path)
+    else:
+        if not bigsky_path.is_file():
+            utils.download(
+                BIG_SKY_DOWNLOAD_URL,
+                bigsky_path,
+                "Big Sky Star Catalog",
+            )
+
+        table = read_bigsky_csv(bigsky_path)
+
+        # write to a temp file first so an interrupted run can't leave a partial cache
+        tmp_path = bigsky_pq_path.with_name(f"{bigsky_pq_path.name}.tmp")
+        pq.write_table(table, tmp_path, compression="snappy")
+        tmp_path.replace(bigsky_pq_path)
+
+    column_names = {
+        "hip_id": "hip",
+        "tyc_id": "tyc",
+        "ra_degrees_j2000": "ra",
+        "dec_degrees_j2000": "dec",
+        "constellation": "constellation_id",
+    }
+    table = table.rename_columns(
+        [column_names.get(name, name) for name in table.column_names]
+    )
+
+    table = table.filter(pc.and_(pc.is_finite(table["ra"]), pc.is_finite(table["dec"])))
+
+    for column in ["ra_mas_per_year", "dec_mas_per_year"]:
+        table = table.set_column(
+            table.column_names.index(column),
+            column,
+            pc.fill_null(table[column], 0.0),
+        )
 
-    if not bigsky_path.is_file():
-        utils.download(
-            BIG_SKY_DOWNLOAD_URL,
-            bigsky_path,
-            "Big Sky Star Catalog",
+    for column in ["constellation_id", "ccdm"]:
+        table = table.set_column(
+            table.column_names.index(column),
+            column,
+            table[column].dictionary_encode(),
         )
 
+    return table
+
+
+def points_wkb(x: np.ndarray, y: np.ndarray) -> pa.Array:
+    points = np.empty(len(x), dtype=WKB_POINT)
+    points["byte_order"] = 1
+    points["type"] = 1
+    points["x"] = x
+    points["y"] = y
+
+    offsets = np.arange(len(x) + 1, dtype="int32") * WKB_POINT.itemsize
+
+    return pa.Array.from_buffers(
+        pa.binary(), len(x), [None, pa.py_buffer(offsets), pa.py_buffer(points)]
+    )
+
+
+def add_position_columns(stars: pa.Table) -> pa.Table:
+    ra = stars["ra"].to_numpy()
+    dec = stars["dec"].to_numpy()
+    healpix = HEALPix(nside=HEALPIX_NSIDE, order="nested")
+
+    stars = stars.append_column("geometry", points_wkb(ra, dec))
+    stars = stars.append_column(
+        "healpix_index",
+        pa.array(healpix.lonlat_to_healpix(ra * u.deg, dec * u.deg)),
+    )
+
+    return stars
+
+
+def build_magnitude(stars: pa.Table, limiting_magnitude: float, expected_count: int):
     output_path = (
         BUILD_PATH / f"stars.bigksy.{__version__}.mag{limiting_magnitude}.parquet"
     )
 
-    df = pd.read_csv(
-        bigsky_path,
-        header=0,
-        usecols=[
-            "tyc_id",
-            "hip_id",
-            "ccdm",
-            "magnitude",
-            "bv",
-            "ra_degrees_j2000",
-            "dec_degrees_j2000",
-            "ra_mas_per_year",
-            "dec_mas_per_year",
-            "parallax_mas",
-            "constellation",
-        ],
-        compression="gzip",
+    # stars arrive sorted, so renumber pk by source order within this catalog
+    stars = stars.set_column(
+        stars.column_names.index("pk"),
+        "pk",
+        pc.rank(stars["pk"], sort_keys="ascending").cast(pa.int32()),
     )
-    df = df.assign(epoch_year=2000)
-    df = df.rename(
-        columns={
-            "hip_id": "hip",
-            "tyc_id": "tyc",
-            "ra_degrees_j2000": "ra",
-            "dec_degrees_j2000": "dec",
-            "constellation": "constellation_id",
-        }
+    stars = stars.append_column(
+        "epoch_year", pa.array(np.full(stars.num_rows, 2000, dtype="int16"))
     )
 
-    def stars(d):
-        ctr = 0
-        for star in d.itertuples():
-            geometry = Point(star.ra, star.dec)
-
-            if (
-                not geometry.is_valid
-                or geometry.is_empty
-                or star.magnitude > limiting_magnitude
-            ):
-                continue
-
-            ctr += 1
-            yield Star(
-                pk=ctr,
-                hip=star.hip,
-                tyc=star.tyc,
-                ra=star.ra,
-                dec=star.dec,
-                constellation_id=star.constellation_id,
-                ccdm=star.ccdm,
-                magnitude=star.magnitude,
-                parallax_mas=star.parallax_mas,
-                ra_mas_per_year=star.ra_mas_per_year or 0,
-                dec_mas_per_year=star.dec_mas_per_year or 0,
-                bv=star.bv,
-                geometry=geometry,
-                epoch_year=2000,
+    columns = [
+        "pk",
+        "hip",
+        "tyc",
+        "ra",
+        "dec",
+        "magnitude",
+        "bv",
+        "parallax_mas",
+        "ra_mas_per_year",
+        "dec_mas_per_year",
+        "constellation_id",
+        "geometry",
+        "ccdm",
+        "epoch_year",
+        "healpix_index",
+    ]
+    stars = stars.select(columns)
+
+    # size row groups by bytes, since row width varies with the column types
+    row_bytes = stars.nbytes / stars.num_rows
+    row_group_size = max(50_000, min(2_000_000, int(ROW_GROUP_BYTES / row_bytes)))
+
+    with pq.ParquetWriter(
+        output_path,
+        stars.schema,
+        compression="zstd",
+        compression_level=1,
+        write_page_index=True,
+        sorting_columns=[pq.SortingColumn(columns.index(c)) for c in SORTING_COLUMNS],
+    ) as writer:
+        for offset in range(0, stars.num_rows, row_group_size):
+            writer.write_table(
+                stars.slice(offset, row_group_size), row_group_size=row_group_size
             )
 
-    catalog = Catalog(path=output_path, healpix_nside=4)
-    catalog.build(
-        objects=stars(df),
-        chunk_size=5_000_000,
-        columns=[
-            "pk",
-            "hip",
-            "tyc",
-            "ra",
-            "dec",
-            "magnitude",
-            "bv",
-            "parallax_mas",
-            "ra_mas_per_year",
-            "dec_mas_per_year",
-            "constellation_id",
-            "geometry",
-            "ccdm",
-            "epoch_year",
-        ],
-        partition_columns=[],
-        sorting_columns=["magnitude", "healpix_index"],
-        compression="snappy",
-        row_group_size=100_000,
-    )
+    # verify from the Parquet footer and row group stats, without loading stars
+    num_rows = pq.ParquetFile(output_path).metadata.num_rows
+
+    logger.info(f"Magnitude {limiting_magnitude} total = {num_rows:,}")
+    assert num_rows == expected_count
+
+    matches = pq.read_table(output_path, filters=[("hip", "=", 32349)]).to_pylist()
+    assert matches, f"Sirius (HIP 32349) not found in {output_path.name}"
 
-    all_stars = [s for s in Star.all(catalog=catalog)]
+    # same tie-break as starplot's Star.get: first match by CCDM, nulls last
+    sirius = min(matches, key=lambda s: (s["ccdm"] is None, s["ccdm"] or ""))
+    assert round(sirius["magnitude"], 2) == -1.44
+    assert sirius["constellation_id"] == "cma"
 
-    logger.info(f"Magnitude {limiting_magnitude} total = {len(all_stars):,}")
-    assert len(all_stars) == expected_count
 
-    sirius = Star.get(name="Sirius", catalog=catalog)
-    assert sirius.magnitude == -1.44
-    assert sirius.hip == 32349
-    assert sirius.constellation_id == "cma"
+def _build_magnitude(stars_path: Path, limiting_magnitude: float, expected_count: int):
+    logger.info(f"Magnitude {limiting_magnitude} - Building...")
+    stars = pa.ipc.open_file(pa.memory_map(str(stars_path))).read_all()
+
+    if pc.max(stars["magnitude"]).as_py() > limiting_magnitude:
+        stars = stars.filter(pc.less_equal(stars["magnitude"], limiting_magnitude))
+
+    build_magnitude(stars, limiting_magnitude, expected_count)
 
 
 def build():
+    _init_logging()
+
     logger.info("Building Big Sky Catalogs...")
     time_start = time.time()
 
-    logger.info("Magnitude 16 - Building...")
-    build_magnitude(16, expected_count=2_557_501)
+    bigsky = load_bigsky()
+
+    stars = bigsky.filter(pc.less_equal(bigsky["magnitude"], 16))
+    stars = add_position_columns(stars)
+    stars = stars.append_column(
+        "pk", pa.array(np.arange(1, stars.num_rows + 1, dtype="int32"))
+    )
+
+    # sort once; filtering keeps the order for each magnitude subset
+    stars = stars.take(
+        pc.sort_indices(
+            stars, sort_keys=[(column, "ascending") for column in SORTING_COLUMNS]
+        )
+    )
+
+    # the IPC file format needs a single dictionary per column
+    stars = stars.unify_dictionaries()
 
-    logger.info("Magnitude 11 - Building...")
-    build_magnitude(11, expected_count=983_823)
+    # workers memory-map the sorted stars from an Arrow IPC file, instead of
+    # forking (or pickling) the table, so any start method works
+    with tempfile.TemporaryDirectory(dir=BUILD_PATH) as tmp_dir:
+        stars_path = Path(tmp_dir) / "stars.arrow"
+        with pa.OSFile(str(stars_path), "wb") as sink:
+            with pa.ipc.new_file(sink, stars.schema) as writer:
+                writer.write_table(stars)
 
-    logger.info("Magnitude 9 - Building...")
-    build_magnitude(9, expected_count=136_126)
+        with ProcessPoolExecutor(
+            max_workers=3,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_logging,
+        ) as executor:
+            futures = [
+                executor.submit(_build_magnitude, stars_path, 16, 2_557_501),
+                executor.submit(_build_magnitude, stars_path, 11, 983_823),
+                executor.submit(_build_magnitude, stars_path, 9, 136_126),
+            ]
+            for future in futures:
+                future.result()
 
     duration = time.time() - time_start
     logger.info(f"Done - {duration:.0f}s")